@@ -1,18 +1,24 @@
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Body, Query
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Body, Query, BackgroundTasks
+from fastapi.responses import JSONResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import redis.asyncio as redis
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict, Any
-import uuid
+from typing import List, Optional, Dict, Any, Tuple
+from ulid import ULID
 from datetime import datetime, timezone, timedelta
-import json
+import orjson
 import asyncio
+from contextlib import suppress
 import math
+import time
+import pygeohash
 from enum import Enum
 
 ROOT_DIR = Path(__file__).parent
@@ -23,10 +29,26 @@ MONGO_URL = os.environ.get("MONGO_URL")
 if not MONGO_URL:
     raise RuntimeError("MONGO_URL not set in environment")
 
-client = AsyncIOMotorClient(MONGO_URL)
+# Datetimes are stored as native BSON dates; tz_aware keeps them UTC-aware on read.
+# zstd (zlib as fallback) shrinks trip-history replies; a short server selection timeout
+# fails requests fast during failover instead of stalling them.
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    tz_aware=True,
+    maxPoolSize=200,
+    minPoolSize=10,
+    compressors="zstd,zlib",
+    serverSelectionTimeoutMS=3000
+)
 DB_NAME = os.getenv("DB_NAME", "cabmatch")
 db = client[DB_NAME]
 
+# Optional Redis GEO index of available drivers (Mongo stays the system of record)
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+# No TTL: stale members are harmless since claims re-check status in Mongo and drop misses
+AVAILABLE_DRIVERS_KEY = "drivers:available"
+
 # ---- App + CORS (single place) ----
 def _parse_origins() -> List[str]:
     # Prefer CORS_ORIGINS (comma-separated), else FRONTEND_ORIGIN, else "*"
@@ -38,8 +60,24 @@ def _parse_origins() -> List[str]:
         return [fo]
     return ["*"]
 
+# ---- JSON encoding (orjson) ----
+def json_dumps(content: Any) -> bytes:
+    # orjson encodes datetime/Enum natively; default=str covers the rest (e.g. Mongo ObjectId)
+    return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+class ORJSONResponse(JSONResponse):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+def model_response(model: BaseModel) -> Response:
+    # Same encoder as stored documents so datetimes look identical across endpoints;
+    # skips FastAPI's response_model re-validation
+    return Response(content=json_dumps(model.model_dump()), media_type="application/json")
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
 
 app.add_middleware(
@@ -61,8 +99,6 @@ def health():
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-security = HTTPBearer()
-
 # Enums
 class DriverStatus(str, Enum):
     offline = "offline"
@@ -81,34 +117,104 @@ class ConnectionManager:
     def __init__(self):
         self.rider_connections: Dict[str, WebSocket] = {}
         self.driver_connections: Dict[str, WebSocket] = {}
+        self._by_role = {"rider": self.rider_connections, "driver": self.driver_connections}
+        # With Redis, messages go through pub/sub channels "<role>:<id>" so that the worker
+        # holding the socket delivers them; each worker only subscribes to its own sockets
+        self.redis: Optional[redis.Redis] = None
+        self.pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+    
+    async def start(self, redis_client: redis.Redis):
+        self.redis = redis_client
+        self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self._listener = asyncio.create_task(self._forward_published())
+    
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._listener
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
     
     async def connect_rider(self, rider_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.rider_connections[rider_id] = websocket
+        await self._connect("rider", rider_id, websocket)
     
     async def connect_driver(self, driver_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.driver_connections[driver_id] = websocket
+        await self._connect("driver", driver_id, websocket)
+    
+    async def disconnect_rider(self, rider_id: str):
+        await self._disconnect("rider", rider_id)
     
-    def disconnect_rider(self, rider_id: str):
-        if rider_id in self.rider_connections:
-            del self.rider_connections[rider_id]
+    async def disconnect_driver(self, driver_id: str):
+        await self._disconnect("driver", driver_id)
     
-    def disconnect_driver(self, driver_id: str):
-        if driver_id in self.driver_connections:
-            del self.driver_connections[driver_id]
+    async def _connect(self, role: str, user_id: str, websocket: WebSocket):
+        await websocket.accept()
+        self._by_role[role][user_id] = websocket
+        if self.pubsub is not None:
+            await self.pubsub.subscribe(f"{role}:{user_id}")
+    
+    async def _disconnect(self, role: str, user_id: str):
+        if self._by_role[role].pop(user_id, None) is not None and self.pubsub is not None:
+            await self.pubsub.unsubscribe(f"{role}:{user_id}")
     
     async def send_to_rider(self, rider_id: str, message: dict):
-        if rider_id in self.rider_connections:
-            await self.rider_connections[rider_id].send_text(json.dumps(message))
+        await self.broadcast([("rider", rider_id)], message)
     
     async def send_to_driver(self, driver_id: str, message: dict):
-        if driver_id in self.driver_connections:
-            await self.driver_connections[driver_id].send_text(json.dumps(message))
+        await self.broadcast([("driver", driver_id)], message)
+    
+    async def broadcast(self, ids: List[Tuple[str, str]], payload: dict):
+        """Encode payload once and send it to every connected (role, id) target"""
+        if self.redis is not None:
+            data = json_dumps(payload)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for role, user_id in ids:
+                    pipe.publish(f"{role}:{user_id}", data)
+                await pipe.execute()
+            return
+        
+        targets = [self._by_role[role][user_id] for role, user_id in ids if user_id in self._by_role[role]]
+        if not targets:
+            return
+        # Text frames so browser clients keep getting strings in event.data
+        data = json_dumps(payload).decode()
+        await asyncio.gather(*(ws.send_text(data) for ws in targets), return_exceptions=True)
+    
+    async def _forward_published(self):
+        """Deliver messages published for sockets connected to this worker"""
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            # Never let one failure end the task, or this worker's sockets stop receiving anything
+            # (CancelledError is not an Exception, so stop() still works)
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                role, user_id = message["channel"].split(":", 1)
+                websocket = self._by_role[role].get(user_id)
+                if websocket is not None:
+                    with suppress(Exception):
+                        await websocket.send_text(message["data"])
+            except Exception:
+                logger.exception("Redis pub/sub forwarding failed, retrying")
+                await asyncio.sleep(1)
 
 manager = ConnectionManager()
 
 # Pydantic Models
+def utc_now() -> datetime:
+    # Truncated to milliseconds, the precision of BSON dates, so a value reads back unchanged
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def new_id() -> str:
+    # ULIDs are time-ordered, so new documents land at the right edge of the id indexes
+    return str(ULID())
+
 class Location(BaseModel):
     type: str = "Point"
     coordinates: List[float]  # [longitude, latitude]
@@ -118,10 +224,10 @@ class RiderCreate(BaseModel):
     phone: str
 
 class Rider(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     name: str
     phone: str
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=utc_now)
 
 class DriverCreate(BaseModel):
     name: str
@@ -129,34 +235,36 @@ class DriverCreate(BaseModel):
     vehicle_no: str
 
 class Driver(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     name: str
     phone: str
     vehicle_no: str
     status: DriverStatus = DriverStatus.offline
     location: Optional[Location] = None
-    last_update: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    location_geohash5: Optional[str] = None
+    last_update: datetime = Field(default_factory=utc_now)
+    created_at: datetime = Field(default_factory=utc_now)
 
 class LocationUpdate(BaseModel):
-    latitude: float
-    longitude: float
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
 
 class TripRequest(BaseModel):
     rider_id: str
-    pickup_latitude: float
-    pickup_longitude: float
-    dropoff_latitude: float
-    dropoff_longitude: float
+    pickup_latitude: float = Field(ge=-90, le=90)
+    pickup_longitude: float = Field(ge=-180, le=180)
+    dropoff_latitude: float = Field(ge=-90, le=90)
+    dropoff_longitude: float = Field(ge=-180, le=180)
 
 class Trip(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     rider_id: str
     driver_id: Optional[str] = None
     pickup: Location
     dropoff: Location
+    pickup_geohash5: Optional[str] = None
     status: TripStatus = TripStatus.requested
-    requested_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    requested_at: datetime = Field(default_factory=utc_now)
     assigned_at: Optional[datetime] = None
     started_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
@@ -200,6 +308,10 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     
     return R * c
 
+def geohash_cell(lat: float, lon: float) -> str:
+    """5-character geohash (~5km cell) used to bucket surge demand and supply"""
+    return pygeohash.encode(lat, lon, precision=5)
+
 def calculate_surge_factor(demand: int, supply: int) -> float:
     """Calculate surge pricing factor based on demand and supply"""
     if supply == 0:
@@ -207,69 +319,147 @@ def calculate_surge_factor(demand: int, supply: int) -> float:
     ratio = demand / supply
     return min(1.0 + 0.6 * max(0, ratio - 1), 2.5)
 
-def serialize_for_mongo(data: dict) -> dict:
-    """Convert datetime objects to ISO strings for MongoDB storage"""
-    for key, value in data.items():
-        if isinstance(value, datetime):
-            data[key] = value.isoformat()
-    return data
-
-def deserialize_from_mongo(data: dict) -> dict:
-    """Convert ISO strings back to datetime objects"""
-    datetime_fields = ['created_at', 'last_update', 'requested_at', 'assigned_at', 'started_at', 'completed_at']
-    for field in datetime_fields:
-        if field in data and isinstance(data[field], str):
-            try:
-                data[field] = datetime.fromisoformat(data[field])
-            except:
-                pass
-    return data
+DRIVER_INDEX_PROJECTION = {"_id": 0, "id": 1, "status": 1, "location": 1}
+# Only what the rider needs to spot the car; keeps trip_assigned payloads small
+MATCHED_DRIVER_PROJECTION = {"_id": 0, "id": 1, "name": 1, "vehicle_no": 1, "location": 1}
+
+async def index_driver(driver: dict):
+    """Keep the Redis GEO index in sync with a driver's status and location"""
+    if redis_client is None:
+        return
+    location = driver.get("location")
+    # Mongo is already written; a Redis hiccup only delays matching (the $near fallback covers it)
+    try:
+        if driver.get("status") == DriverStatus.available.value and location:
+            lon, lat = location["coordinates"]
+            await redis_client.geoadd(AVAILABLE_DRIVERS_KEY, (lon, lat, driver["id"]))
+        else:
+            await redis_client.zrem(AVAILABLE_DRIVERS_KEY, driver["id"])
+    except redis.RedisError:
+        logger.warning("Could not update Redis index for driver %s", driver["id"], exc_info=True)
+
+async def _unindex_drivers(*driver_ids: str):
+    # Best effort: stale members are harmless, so a Redis failure must not undo a Mongo claim
+    try:
+        await redis_client.zrem(AVAILABLE_DRIVERS_KEY, *driver_ids)
+    except redis.RedisError:
+        logger.warning("Could not remove drivers from the Redis index", exc_info=True)
+
+async def release_driver(driver_id: str, now: datetime):
+    """Put a driver back to available and re-index them for matching"""
+    driver = await db.drivers.find_one_and_update(
+        {"id": driver_id, "status": "on_trip"},
+        {"$set": {"status": "available", "last_update": now}},
+        projection=DRIVER_INDEX_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if driver:
+        await index_driver(driver)
+
+async def claim_nearest_driver(pickup_coords: List[float], now: datetime) -> Optional[dict]:
+    """Atomically flip the closest available driver within 10km to on_trip and return it"""
+    claim = {"$set": {"status": "on_trip", "last_update": now}}
+    
+    if redis_client is not None:
+        driver = await _claim_from_redis(pickup_coords, claim)
+        if driver:
+            return driver
+    
+    # Mongo is the system of record: also covers a Redis index that is empty, flushed or behind
+    driver = await db.drivers.find_one_and_update(
+        {
+            "status": "available",
+            "location": {
+                "$near": {
+                    "$geometry": {
+                        "type": "Point",
+                        "coordinates": pickup_coords
+                    },
+                    "$maxDistance": 10000  # 10km in meters
+                }
+            }
+        },
+        claim,
+        projection=MATCHED_DRIVER_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if driver and redis_client is not None:
+        await _unindex_drivers(driver["id"])
+    return driver
+
+async def _claim_from_redis(pickup_coords: List[float], claim: dict) -> Optional[dict]:
+    try:
+        candidate_ids = await redis_client.geosearch(
+            AVAILABLE_DRIVERS_KEY,
+            longitude=pickup_coords[0],
+            latitude=pickup_coords[1],
+            radius=10,
+            unit="km",
+            sort="ASC",
+            count=10
+        )
+    except redis.RedisError:
+        logger.warning("Redis GEOSEARCH failed, matching through Mongo", exc_info=True)
+        return None
+    
+    # GEOSEARCH returns candidates nearest-first; Redis only ranks them, the claim itself
+    # is still guarded by Mongo's status field
+    for tried, candidate_id in enumerate(candidate_ids, start=1):
+        driver = await db.drivers.find_one_and_update(
+            {"id": candidate_id, "status": "available"},
+            claim,
+            projection=MATCHED_DRIVER_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+        if driver:
+            await _unindex_drivers(*candidate_ids[:tried])
+            return driver
+    
+    if candidate_ids:
+        await _unindex_drivers(*candidate_ids)
+    return None
 
 # Authentication Routes
 @api_router.post("/auth/rider/register", response_model=AuthResponse)
 async def register_rider(rider_data: RiderCreate):
-    # Check if rider already exists
-    existing_rider = await db.riders.find_one({"phone": rider_data.phone})
-    if existing_rider:
-        raise HTTPException(status_code=400, detail="Phone number already registered")
-    
-    rider = Rider(**rider_data.dict())
-    rider_dict = serialize_for_mongo(rider.dict())
+    rider = Rider(**rider_data.model_dump())
+    rider_dict = rider.model_dump()
     
-    await db.riders.insert_one(rider_dict)
+    # Unique phone index rejects already-registered numbers
+    try:
+        await db.riders.insert_one(rider_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Phone number already registered")
     
     # Simple token for MVP (in production, use JWT)
     token = f"rider_{rider.id}"
     
-    return AuthResponse(
+    return model_response(AuthResponse(
         user_id=rider.id,
         user_type="rider",
         token=token
-    )
+    ))
 
 @api_router.post("/auth/driver/register", response_model=AuthResponse)
 async def register_driver(driver_data: DriverCreate):
-    # Check if driver already exists
-    existing_driver = await db.drivers.find_one({"phone": driver_data.phone})
-    if existing_driver:
-        raise HTTPException(status_code=400, detail="Phone number already registered")
-    
-    driver = Driver(**driver_data.dict())
-    driver_dict = serialize_for_mongo(driver.dict())
-    
-    await db.drivers.insert_one(driver_dict)
+    now = utc_now()
+    driver = Driver(**driver_data.model_dump(), last_update=now, created_at=now)
+    driver_dict = driver.model_dump()
     
-    # Create geospatial index for driver locations
-    await db.drivers.create_index([("location", "2dsphere")])
+    # Unique phone index rejects already-registered numbers
+    try:
+        await db.drivers.insert_one(driver_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Phone number already registered")
     
     # Simple token for MVP
     token = f"driver_{driver.id}"
     
-    return AuthResponse(
+    return model_response(AuthResponse(
         user_id=driver.id,
         user_type="driver", 
         token=token
-    )
+    ))
 
 @api_router.post("/auth/login", response_model=AuthResponse)
 async def login(payload: LoginRequest = Body(None), phone_q: str = Query(None ,alias="phone")):
@@ -277,15 +467,18 @@ async def login(payload: LoginRequest = Body(None), phone_q: str = Query(None ,a
     if not phone:
         raise HTTPException(status_code=422, detail="phone is required")
 
-    rider = await db.riders.find_one({"phone": phone})
+    # Look up both collections at once; riders still take precedence
+    rider, driver = await asyncio.gather(
+        db.riders.find_one({"phone": phone}, {"id": 1, "_id": 0}),
+        db.drivers.find_one({"phone": phone}, {"id": 1, "_id": 0})
+    )
     if rider:
         token = f"rider_{rider['id']}"
-        return AuthResponse(user_id=rider['id'], user_type="rider", token=token)
+        return model_response(AuthResponse(user_id=rider['id'], user_type="rider", token=token))
 
-    driver = await db.drivers.find_one({"phone": phone})
     if driver:
         token = f"driver_{driver['id']}"
-        return AuthResponse(user_id=driver['id'], user_type="driver", token=token)
+        return model_response(AuthResponse(user_id=driver['id'], user_type="driver", token=token))
 
     raise HTTPException(status_code=404, detail="User not found")
 
@@ -294,19 +487,24 @@ async def login(payload: LoginRequest = Body(None), phone_q: str = Query(None ,a
 async def update_driver_location(driver_id: str, location_update: LocationUpdate):
     location = Location(coordinates=[location_update.longitude, location_update.latitude])
     
-    result = await db.drivers.update_one(
+    driver = await db.drivers.find_one_and_update(
         {"id": driver_id},
         {
             "$set": {
-                "location": location.dict(),
-                "last_update": datetime.now(timezone.utc).isoformat()
+                "location": location.model_dump(),
+                "location_geohash5": geohash_cell(location_update.latitude, location_update.longitude),
+                "last_update": utc_now()
             }
-        }
+        },
+        projection=DRIVER_INDEX_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if not driver:
         raise HTTPException(status_code=404, detail="Driver not found")
     
+    await index_driver(driver)
+    
     return {"message": "Location updated successfully"}
 
 @api_router.put("/drivers/{driver_id}/status")
@@ -316,37 +514,42 @@ async def update_driver_status(driver_id: str,
     new_status = (body.status if body and body.status else status_q)
     if not new_status:
         raise HTTPException(status_code=422, detail="status is required")
-    result = await db.drivers.update_one(
+    driver = await db.drivers.find_one_and_update(
         {"id": driver_id},
         {"$set": {
             "status": new_status.value if isinstance(new_status, DriverStatus) else str(new_status),
-            "last_update": datetime.now(timezone.utc).isoformat()
-        }}
+            "last_update": utc_now()
+        }},
+        projection=DRIVER_INDEX_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
-    if result.matched_count == 0:
+    if not driver:
         raise HTTPException(status_code=404, detail="Driver not found")
+    await index_driver(driver)
     return {"message": "Status updated successfully"}
 
+# Read endpoints return the stored documents as-is; response_model only documents the schema
+# (FastAPI skips validation and jsonable_encoder when a Response is returned)
 @api_router.get("/drivers/{driver_id}", response_model=Driver)
 async def get_driver(driver_id: str):
-    driver = await db.drivers.find_one({"id": driver_id})
+    driver = await db.drivers.find_one({"id": driver_id}, {"_id": 0})
     if not driver:
         raise HTTPException(status_code=404, detail="Driver not found")
     
-    return Driver(**deserialize_from_mongo(driver))
+    return ORJSONResponse(driver)
 
 # Rider Routes
 @api_router.get("/riders/{rider_id}", response_model=Rider)
 async def get_rider(rider_id: str):
-    rider = await db.riders.find_one({"id": rider_id})
+    rider = await db.riders.find_one({"id": rider_id}, {"_id": 0})
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
     
-    return Rider(**deserialize_from_mongo(rider))
+    return ORJSONResponse(rider)
 
 # Trip Routes
 @api_router.post("/trips/request", response_model=Trip)
-async def request_trip(trip_request: TripRequest):
+async def request_trip(trip_request: TripRequest, background_tasks: BackgroundTasks):
     # Verify rider exists
     rider = await db.riders.find_one({"id": trip_request.rider_id})
     if not rider:
@@ -356,82 +559,111 @@ async def request_trip(trip_request: TripRequest):
     trip = Trip(
         rider_id=trip_request.rider_id,
         pickup=Location(coordinates=[trip_request.pickup_longitude, trip_request.pickup_latitude]),
+        pickup_geohash5=geohash_cell(trip_request.pickup_latitude, trip_request.pickup_longitude),
         dropoff=Location(coordinates=[trip_request.dropoff_longitude, trip_request.dropoff_latitude])
     )
     
-    trip_dict = serialize_for_mongo(trip.dict())
+    trip_dict = trip.model_dump()
     await db.trips.insert_one(trip_dict)
     
-    # Find nearest available driver
-    await match_driver(trip.id)
+    # Find nearest available driver after the response is sent
+    background_tasks.add_task(match_driver, trip.id)
     
-    return trip
+    return model_response(trip)
 
 async def match_driver(trip_id: str):
     """Background task to match a driver to a trip"""
-    trip = await db.trips.find_one({"id": trip_id})
+    trip = await db.trips.find_one(
+        {"id": trip_id},
+        {"_id": 0, "rider_id": 1, "status": 1, "pickup": 1, "dropoff": 1}
+    )
     if not trip or trip['status'] != 'requested':
         return
     
+    now = utc_now()
+    
     # Find available drivers near pickup location
     pickup_coords = trip['pickup']['coordinates']
     
-    # Query for available drivers within 10km radius
-    nearby_drivers = await db.drivers.find({
-        "status": "available",
-        "location": {
-            "$near": {
-                "$geometry": {
-                    "type": "Point",
-                    "coordinates": pickup_coords
-                },
-                "$maxDistance": 10000  # 10km in meters
-            }
-        }
-    }).to_list(10)
-    
+    # Atomically claim the closest available driver within 10km radius
+    best_driver = await claim_nearest_driver(pickup_coords, now)
     
-    if nearby_drivers:
-        # Select closest driver
-        best_driver = nearby_drivers[0]
-        
+    if best_driver:
         # Assign trip to driver
-        await db.trips.update_one(
-            {"id": trip_id},
+        result = await db.trips.update_one(
+            {"id": trip_id, "status": "requested"},
             {
                 "$set": {
                     "driver_id": best_driver['id'],
                     "status": "assigned",
-                    "assigned_at": datetime.now(timezone.utc).isoformat()
+                    "assigned_at": now
                 }
             }
         )
         
-        # Update driver status
-        await db.drivers.update_one(
-            {"id": best_driver['id']},
-            {"$set": {"status": "on_trip"}}
-        )
+        if result.matched_count == 0:
+            # Trip changed state meanwhile; release the driver
+            await release_driver(best_driver['id'], now)
+            return
         
         # Send real-time notifications
-        await manager.send_to_rider(trip['rider_id'], {
+        await manager.broadcast([("rider", trip['rider_id']), ("driver", best_driver['id'])], {
             "type": "trip_assigned",
             "trip_id": trip_id,
-            "driver": best_driver
-        })
-        
-        await manager.send_to_driver(best_driver['id'], {
-            "type": "trip_assigned", 
-            "trip_id": trip_id,
-            "trip": trip
+            "driver": best_driver,
+            "trip": {"pickup": trip['pickup'], "dropoff": trip['dropoff']}
         })
 
+@app.on_event("startup")
+async def start_ws_fanout():
+    if redis_client is not None:
+        await manager.start(redis_client)
+
 @app.on_event("startup")
 async def ensure_indexes():
     await db.riders.create_index("id", unique=True)
     await db.drivers.create_index("id", unique=True)
     await db.trips.create_index("id", unique=True)
-    await db.drivers.create_index([("location", "2dsphere")])  # for $near
+    await db.riders.create_index("phone", unique=True)
+    await db.drivers.create_index("phone", unique=True)
+    await db.trips.create_index([("pickup_geohash5", 1), ("requested_at", 1)])  # surge demand per cell
+    await db.drivers.create_index([("location_geohash5", 1), ("status", 1)])  # surge supply per cell
+    await db.drivers.create_index([("status", 1), ("location", "2dsphere")])  # for available-driver $near
+    # Superseded by the compound index above; keeping it would double 2dsphere upkeep per heartbeat
+    with suppress(OperationFailure):
+        await db.drivers.drop_index("location_2dsphere")
+
+@app.on_event("startup")
+async def seed_driver_index():
+    # Rebuild the Redis GEO set from Mongo so matching works right after a Redis restart/flush
+    if redis_client is None:
+        return
+    members = []
+    async for driver in db.drivers.find(
+        {"status": "available", "location": {"$ne": None}},
+        {"_id": 0, "id": 1, "location": 1}
+    ):
+        lon, lat = driver["location"]["coordinates"]
+        members.extend((lon, lat, driver["id"]))
+    if members:
+        await redis_client.geoadd(AVAILABLE_DRIVERS_KEY, members)
+
+@app.on_event("startup")
+async def backfill_driver_geohashes():
+    # Drivers located before surge bucketing have no cell; without one they never count as supply
+    updates = [
+        UpdateOne(
+            {"id": driver["id"]},
+            {"$set": {"location_geohash5": geohash_cell(driver["location"]["coordinates"][1],
+                                                        driver["location"]["coordinates"][0])}}
+        )
+        async for driver in db.drivers.find(
+            {"location": {"$ne": None}, "location_geohash5": {"$exists": False}},
+            {"_id": 0, "id": 1, "location": 1}
+        )
+    ]
+    if updates:
+        await db.drivers.bulk_write(updates, ordered=False)
 
 @api_router.put("/trips/{trip_id}/start")
 async def start_trip(trip_id: str):
@@ -440,7 +672,7 @@ async def start_trip(trip_id: str):
         {
             "$set": {
                 "status": "ongoing",
-                "started_at": datetime.now(timezone.utc).isoformat()
+                "started_at": utc_now()
             }
         }
     )
@@ -460,9 +692,12 @@ async def start_trip(trip_id: str):
 
 @api_router.put("/trips/{trip_id}/complete")
 async def complete_trip(trip_id: str):
+    now = utc_now()
     trip = await db.trips.find_one({"id": trip_id})
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
+    if trip['status'] != 'ongoing':
+        raise HTTPException(status_code=404, detail="Trip not found or not in ongoing state")
     
     # Calculate distance and fare
     pickup_coords = trip['pickup']['coordinates']
@@ -482,7 +717,7 @@ async def complete_trip(trip_id: str):
         {
             "$set": {
                 "status": "completed",
-                "completed_at": datetime.now(timezone.utc).isoformat(),
+                "completed_at": now,
                 "distance_km": distance,
                 "fare": fare
             }
@@ -492,77 +727,99 @@ async def complete_trip(trip_id: str):
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Trip not found or not in ongoing state")
     
-    # Update driver status back to available
+    # Only the request that actually completed the trip frees its driver
     if trip['driver_id']:
-        await db.drivers.update_one(
-            {"id": trip['driver_id']},
-            {"$set": {"status": "available"}}
-        )
+        await release_driver(trip['driver_id'], now)
     
     # Send updates
-    await manager.send_to_rider(trip['rider_id'], {
-        "type": "trip_completed",
-        "trip_id": trip_id,
-        "fare": fare,
-        "distance": distance
-    })
-    
-    await manager.send_to_driver(trip['driver_id'], {
-        "type": "trip_completed",
-        "trip_id": trip_id
-    })
+    await asyncio.gather(
+        manager.send_to_rider(trip['rider_id'], {
+            "type": "trip_completed",
+            "trip_id": trip_id,
+            "fare": fare,
+            "distance": distance
+        }),
+        manager.send_to_driver(trip['driver_id'], {
+            "type": "trip_completed",
+            "trip_id": trip_id
+        })
+    )
     
     return {"message": "Trip completed", "fare": fare, "distance": distance}
 
 @api_router.get("/trips/{trip_id}", response_model=Trip)
 async def get_trip(trip_id: str):
-    trip = await db.trips.find_one({"id": trip_id})
+    trip = await db.trips.find_one({"id": trip_id}, {"_id": 0})
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     
-    return Trip(**deserialize_from_mongo(trip))
+    return ORJSONResponse(trip)
 
 @api_router.get("/riders/{rider_id}/trips", response_model=List[Trip])
 async def get_rider_trips(rider_id: str):
-    trips = await db.trips.find({"rider_id": rider_id}).sort("requested_at", -1).to_list(50)
-    return [Trip(**deserialize_from_mongo(trip)) for trip in trips]
+    trips = await db.trips.find({"rider_id": rider_id}, {"_id": 0}).sort("requested_at", -1).to_list(50)
+    return ORJSONResponse(trips)
 
 @api_router.get("/drivers/{driver_id}/trips", response_model=List[Trip])
 async def get_driver_trips(driver_id: str):
-    trips = await db.trips.find({"driver_id": driver_id}).sort("requested_at", -1).to_list(50)
-    return [Trip(**deserialize_from_mongo(trip)) for trip in trips]
+    trips = await db.trips.find({"driver_id": driver_id}, {"_id": 0}).sort("requested_at", -1).to_list(50)
+    return ORJSONResponse(trips)
 
 # Pricing Routes
-@api_router.get("/pricing/estimate", response_model=PricingEstimate)
-async def estimate_fare(pickup_lat: float, pickup_lon: float, dropoff_lat: float, dropoff_lon: float):
-    distance = haversine_distance(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
-    
-    base_fare = 50.0
-    per_km_rate = 15.0
+SURGE_CACHE_TTL = 10  # seconds
+_surge_cache: Dict[str, Tuple[float, float]] = {}  # geohash cell -> (surge_factor, computed_at)
+
+async def get_surge_factor(pickup_lat: float, pickup_lon: float) -> float:
+    """Surge factor for the pickup's geohash cell, cached briefly per cell"""
+    bucket = geohash_cell(pickup_lat, pickup_lon)
+    now = time.monotonic()
+    cached = _surge_cache.get(bucket)
+    if cached and now - cached[1] < SURGE_CACHE_TTL:
+        return cached[0]
     
     # Calculate demand/supply for surge pricing
-    # Count recent trip requests in area (last 5 minutes) - simplified for MVP
-    five_min_ago = datetime.now(timezone.utc) - timedelta(minutes=5)
+    # Count recent trip requests in the cell (last 5 minutes)
+    five_min_ago = utc_now() - timedelta(minutes=5)
     demand = await db.trips.count_documents({
-        "requested_at": {"$gte": five_min_ago.isoformat()}
+        "pickup_geohash5": bucket,
+        "requested_at": {"$gte": five_min_ago}
     })
     
-    # Count available drivers in area - simplified for MVP
+    # Count available drivers in the cell
     supply = await db.drivers.count_documents({
+        "location_geohash5": bucket,
         "status": "available"
     })
     
     surge_factor = calculate_surge_factor(demand, supply)
+    
+    # Drop expired buckets so the cache can't grow without bound
+    for key in [k for k, (_, ts) in _surge_cache.items() if now - ts >= SURGE_CACHE_TTL]:
+        del _surge_cache[key]
+    _surge_cache[bucket] = (surge_factor, now)
+    return surge_factor
+
+@api_router.get("/pricing/estimate", response_model=PricingEstimate)
+async def estimate_fare(pickup_lat: float = Query(ge=-90, le=90),
+                        pickup_lon: float = Query(ge=-180, le=180),
+                        dropoff_lat: float = Query(ge=-90, le=90),
+                        dropoff_lon: float = Query(ge=-180, le=180)):
+    distance = haversine_distance(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+    
+    base_fare = 50.0
+    per_km_rate = 15.0
+    
+    surge_factor = await get_surge_factor(pickup_lat, pickup_lon)
     base_cost = base_fare + (per_km_rate * distance)
     estimated_fare = base_cost * surge_factor
     
-    return PricingEstimate(
+    return model_response(PricingEstimate(
         base_fare=base_fare,
         distance_km=distance,
         per_km_rate=per_km_rate,
         surge_factor=surge_factor,
         estimated_fare=estimated_fare
-    )
+    ))
 
 # WebSocket Routes
 @app.websocket("/ws/rider/{rider_id}")
@@ -574,7 +831,7 @@ async def websocket_rider(websocket: WebSocket, rider_id: str):
             # Handle incoming messages if needed
             pass
     except WebSocketDisconnect:
-        manager.disconnect_rider(rider_id)
+        await manager.disconnect_rider(rider_id)
 
 @app.websocket("/ws/driver/{driver_id}")
 async def websocket_driver(websocket: WebSocket, driver_id: str):
@@ -585,7 +842,7 @@ async def websocket_driver(websocket: WebSocket, driver_id: str):
             # Handle incoming messages if needed
             pass
     except WebSocketDisconnect:
-        manager.disconnect_driver(driver_id)
+        await manager.disconnect_driver(driver_id)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -600,8 +857,13 @@ logger = logging.getLogger(__name__)
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    await manager.stop()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("server:app", host="0.0.0.0", port=port, reload=False)
+    # More than one worker needs REDIS_URL so WebSocket messages reach every worker
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run("server:app", host="0.0.0.0", port=port, reload=False, workers=workers)
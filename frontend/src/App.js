@@ -726,7 +726,7 @@ const RiderDashboard = ({ user, onLogout }) => {
                   <div className="flex justify-between items-center">
                     <span className="text-sm text-gray-600">Trip ID</span>
                     <span className="text-sm font-mono bg-gray-100 px-2 py-1 rounded">
-                      {currentTrip.id.slice(0, 8)}...
+                      ...{currentTrip.id.slice(-8)}
                     </span>
                   </div>
                   